@@ -1,13 +1,17 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import Optional
-import base64
 import binascii
 
+import pybase64
+
 
 from mail_engine import run_mail_check
 
-app = FastAPI(title="NIRMAIL Backend")
+# orjson serializes the large signature/tree payloads in C instead of
+# stdlib json's Python-level walk.
+app = FastAPI(title="NIRMAIL Backend", default_response_class=ORJSONResponse)
 
 
 class CheckRequest(BaseModel):
@@ -21,12 +25,12 @@ class CheckRequest(BaseModel):
 from fastapi import HTTPException
 
 @app.post("/check")
-def check_mail(req: CheckRequest):
+async def check_mail(req: CheckRequest):
     raw_email = None
 
     if req.raw_email_b64:
         try:
-            raw_email = base64.b64decode(req.raw_email_b64, validate=True)
+            raw_email = pybase64.b64decode(req.raw_email_b64, validate=True)
         except binascii.Error:
             raise HTTPException(
                 status_code=400,
@@ -34,7 +38,7 @@ def check_mail(req: CheckRequest):
             )
 
     try:
-        return run_mail_check(
+        return await run_mail_check(
             domain=req.domain,
             sender_ip=req.sender_ip,
             mail_from=req.mail_from,
@@ -50,3 +54,37 @@ def check_mail(req: CheckRequest):
             status_code=500,
             detail="Mail authentication processing failed"
         )
+
+
+@app.post("/check-raw")
+async def check_mail_raw(
+    request: Request,
+    domain: str,
+    sender_ip: str,
+    mail_from: Optional[str] = None,
+    helo: Optional[str] = None,
+):
+    # Streams the message bytes straight from the request body: no JSON
+    # field, no base64 string at ~1.33x the message size, no decoded
+    # extra copy. Check parameters travel as query parameters.
+    buf = bytearray()
+    async for chunk in request.stream():
+        buf += chunk
+
+    try:
+        return await run_mail_check(
+            domain=domain,
+            sender_ip=sender_ip,
+            mail_from=mail_from,
+            helo=helo,
+            raw_email=bytes(buf) if buf else None,
+        )
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(
+            status_code=500,
+            detail="Mail authentication processing failed"
+        )
@@ -1,229 +1,422 @@
-import dkim
-import re
-from typing import Dict, List, Optional
-
-
-DKIM_HEADER_RE = re.compile(
-    rb"^DKIM-Signature:\s*(.+?)(?:\r\n(?!\s)|$)",
-    re.IGNORECASE | re.MULTILINE | re.DOTALL,
-)
-
-TAG_RE = re.compile(rb"([a-zA-Z]+)=([^;]+)")
-
-ARC_SEAL_RE = re.compile(
-    rb"^ARC-Seal:\s*(.+?)(?:\r\n(?!\s)|$)",
-    re.IGNORECASE | re.MULTILINE | re.DOTALL,
-)
-
-ARC_AUTH_RE = re.compile(
-    rb"^ARC-Authentication-Results:\s*(.+?)(?:\r\n(?!\s)|$)",
-    re.IGNORECASE | re.MULTILINE | re.DOTALL,
-)
-
-
-def _unfold_header(value: bytes) -> bytes:
-    return re.sub(rb"\r\n\s+", b" ", value).strip()
-
-
-def _parse_dkim_tags(header_value: bytes) -> Dict[str, str]:
-    tags: Dict[str, str] = {}
-    header_value = _unfold_header(header_value)
-
-    for k, v in TAG_RE.findall(header_value):
-        tags[k.decode().lower()] = v.decode(errors="ignore").strip()
-
-    return tags
-
-
-def _extract_dkim_signatures(raw_email: bytes) -> List[Dict]:
-    if isinstance(raw_email, str):
-        raw_email = raw_email.encode(errors="ignore")
-
-    headers_blob = raw_email.split(b"\r\n\r\n", 1)[0]
-    signatures: List[Dict] = []
-
-    for match in DKIM_HEADER_RE.finditer(headers_blob):
-        raw_header = match.group(1)
-        tags = _parse_dkim_tags(raw_header)
-
-        if "d" not in tags or "s" not in tags:
-            continue
-
-        signatures.append({
-            "domain": tags["d"].lower(),
-            "selector": tags["s"],
-            "algorithm": tags.get("a"),
-            "canonicalization": tags.get("c"),
-            "raw": raw_header,
-        })
-
-    return signatures
-
-
-def _verify_dkim(raw_email: bytes) -> Dict:
-    if isinstance(raw_email, str):
-        raw_email = raw_email.encode(errors="ignore")
-
-    try:
-        valid = dkim.verify(raw_email)
-        return {
-            "dkim_present": True,
-            "dkim_result": "PASS" if valid else "FAIL",
-            "dkim_valid": valid,
-        }
-
-    except dkim.DKIMTemporaryError as e:
-        return {
-            "dkim_present": True,
-            "dkim_result": "TEMPERROR",
-            "dkim_valid": False,
-            "error": str(e),
-        }
-
-    except dkim.DKIMException as e:
-        return {
-            "dkim_present": True,
-            "dkim_result": "PERMERROR",
-            "dkim_valid": False,
-            "error": str(e),
-        }
-
-
-def _extract_arc_info(raw_email: bytes) -> Dict:
-    if isinstance(raw_email, str):
-        raw_email = raw_email.encode(errors="ignore")
-
-    headers_blob = raw_email.split(b"\r\n\r\n", 1)[0]
-
-    arc_seal = None
-    arc_auth = None
-
-    for line in headers_blob.split(b"\r\n"):
-        if line.lower().startswith(b"arc-seal:"):
-            arc_seal = line
-        elif arc_seal and line.startswith(b" "):
-            arc_seal += b"\r\n" + line
-        elif arc_seal:
-            break
-
-    for line in headers_blob.split(b"\r\n"):
-        if line.lower().startswith(b"arc-authentication-results:"):
-            arc_auth = line
-        elif arc_auth and line.startswith(b" "):
-            arc_auth += b"\r\n" + line
-        elif arc_auth:
-            break
-
-    if not arc_seal:
-        return {"arc_present": False}
-
-    arc_seal = _unfold_header(arc_seal).decode(errors="ignore")
-
-    signer = None
-    m = re.search(r"\bd=([^;\s]+)", arc_seal)
-    if m:
-        signer = m.group(1)
-
-    arc_auth_value = None
-    if arc_auth:
-        arc_auth_value = _unfold_header(arc_auth).decode(errors="ignore")
-
-    return {
-        "arc_present": True,
-        "arc_signer": signer,
-        "arc_authentication_results": arc_auth_value,
-        "arc_note": (
-            "ARC indicates the message was authenticated by an upstream receiver. "
-            "DKIM verification may fail locally due to header modifications. "
-            "ARC is informational and not cryptographically re-verified."
-        ),
-    }
-
-
-def _select_dkim_for_dmarc(
-    signatures: List[Dict],
-    header_from_domain: Optional[str],
-) -> Optional[str]:
-
-    if not signatures:
-        return None
-
-    if header_from_domain:
-        header_from_domain = header_from_domain.lower()
-
-        for sig in signatures:
-            d = sig["domain"]
-            if header_from_domain == d or header_from_domain.endswith("." + d):
-                return d
-
-    return signatures[0]["domain"]
-
-
-def check_dkim(
-    raw_email: bytes,
-    header_from_domain: Optional[str] = None,
-) -> Dict:
-
-    verification = _verify_dkim(raw_email)
-    signatures = _extract_dkim_signatures(raw_email)
-    arc_info = _extract_arc_info(raw_email)
-
-    dkim_domain = _select_dkim_for_dmarc(
-        signatures,
-        header_from_domain,
-    )
-
-    verification.update({
-        "dkim_domain": dkim_domain,
-        "dkim_aligned": False,
-        "dkim_signatures_found": len(signatures),
-        "dkim_signatures": signatures,
-        "arc": arc_info,
-    })
-
-    return verification
-
-
-def build_dkim_tree(
-    dkim_result: Dict,
-    header_from_domain: Optional[str],
-) -> List[str]:
-
-    tree = []
-    tree.append("DKIM Verification")
-
-    if not dkim_result.get("dkim_present"):
-        tree.append(" ├─ DKIM-Signature present: NO")
-        tree.append(" └─ DKIM RESULT → NONE")
-        return tree
-
-    tree.append(f" ├─ DKIM-Signatures found: {dkim_result['dkim_signatures_found']}")
-
-    for idx, sig in enumerate(dkim_result.get("dkim_signatures", []), 1):
-        tree.append(f" │  ├─ Signature #{idx}")
-        tree.append(f" │  │  ├─ d = {sig['domain']}")
-        tree.append(f" │  │  ├─ s = {sig['selector']}")
-        tree.append(f" │  │  ├─ algorithm = {sig.get('algorithm')}")
-        tree.append(f" │  │  └─ canonicalization = {sig.get('canonicalization')}")
-
-    tree.append(" ├─ Cryptographic verification")
-    tree.append(f" │  └─ Result → {dkim_result['dkim_result']}")
-
-    arc = dkim_result.get("arc", {})
-    if arc.get("arc_present"):
-        tree.append(" ├─ ARC detected")
-        tree.append(f" │  ├─ ARC signer → {arc.get('arc_signer')}")
-        tree.append(" │  └─ Note → Message authenticated upstream (ARC is informational)")
-
-    if header_from_domain:
-        tree.append(f" ├─ Header-From domain = {header_from_domain}")
-        tree.append(" ├─ DKIM domain selection for DMARC")
-
-        if dkim_result.get("dkim_domain"):
-            tree.append(f" │  └─ Selected DKIM domain → {dkim_result['dkim_domain']}")
-        else:
-            tree.append(" │  └─ No DKIM domain usable for DMARC")
-
-    tree.append(f" └─ DKIM FINAL RESULT → {dkim_result['dkim_result']}")
-
-    return tree
+import base64
+import dkim
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dkim.canonicalization import CanonicalizationPolicy
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, utils
+
+
+_CRYPTO_HASHES = {"sha1": hashes.SHA1, "sha256": hashes.SHA256}
+
+_py_rsa_verify = dkim.RSASSA_PKCS1_v1_5_verify
+
+
+def _openssl_rsa_verify(hash, signature, public_key) -> bool:
+    """Drop-in for dkimpy's pure-Python RSASSA-PKCS1-v1_5 verify.
+
+    Same (hash, signature, key-dict) contract, but the modular
+    exponentiation and padding check run inside OpenSSL. Falls back to
+    the stock implementation on anything unexpected."""
+    try:
+        pub = rsa.RSAPublicNumbers(
+            public_key["publicExponent"], public_key["modulus"]
+        ).public_key()
+        pub.verify(
+            signature,
+            hash.digest(),
+            padding.PKCS1v15(),
+            utils.Prehashed(_CRYPTO_HASHES[hash.name.lower()]()),
+        )
+        return True
+    except InvalidSignature:
+        return False
+    except (KeyError, TypeError, ValueError):
+        return _py_rsa_verify(hash, signature, public_key)
+
+
+# verify_sig_process resolves the verify primitive from dkim's module
+# globals, so rebinding it here routes all RSA verification through
+# OpenSSL without touching the library's canonicalization or parsing.
+dkim.RSASSA_PKCS1_v1_5_verify = _openssl_rsa_verify
+
+
+_TAG_FINDITER = re.compile(rb"([a-zA-Z]+)=([^;]+)").finditer
+
+_ARC_SIGNER_SEARCH = re.compile(r"\bd=([^;\s]+)").search
+
+_MISSING = object()
+
+# Header lines end in CRLF per RFC 5322, but LF-only messages are
+# common in practice (.eml files, unix pipelines); the alternation
+# consumes the \r with its \n so no stray \r survives.
+_LINE_SPLIT = re.compile(rb"\r\n|\n").split
+
+
+def _body_hash_matches(body: bytes, sig: Dict, cache: Dict) -> bool:
+    """Cheap bh= precheck: hash the canonicalized body once per
+    (c=, a=, l=) combination and compare against the signature's bh= tag.
+    Returns True on any doubt so the full verify path decides."""
+
+    if b"bh" not in sig:
+        return True
+
+    key = (sig.get(b"c", b"simple/simple"), sig[b"a"], sig.get(b"l"))
+    digest = cache.get(key, _MISSING)
+
+    if digest is _MISSING:
+        try:
+            policy = CanonicalizationPolicy.from_c_value(
+                sig.get(b"c", b"simple/simple")
+            )
+            canon = policy.canonicalize_body(body)
+            if b"l" in sig:
+                canon = memoryview(canon)[:int(sig[b"l"])]
+            digest = dkim.HASH_ALGORITHMS[sig[b"a"]](canon).digest()
+        except Exception:
+            digest = None
+        cache[key] = digest
+
+    if digest is None:
+        return True
+
+    try:
+        bh = base64.b64decode(re.sub(rb"\s+", b"", sig[b"bh"]))
+    except Exception:
+        return True
+
+    return digest == bh
+
+
+def header_view(raw_email: bytes) -> memoryview:
+    """Zero-copy view of the header block, delimited by the first blank
+    line (CRLF or bare LF, so .eml files with LF endings still parse).
+    Avoids the full-message scan and copy of split(b"\\r\\n\\r\\n")."""
+    i = raw_email.find(b"\r\n\r\n")
+    j = raw_email.find(b"\n\n")
+    if i < 0 or (0 <= j < i):
+        i = j
+    return memoryview(raw_email)[:i if i >= 0 else len(raw_email)]
+
+
+def _parse_dkim_tags(header_value: bytes) -> Dict[str, str]:
+    # finditer avoids materializing a full list of (k, v) bytestring
+    # tuples, which matters for long b=/bh= values; DKIM tags are ASCII
+    # by spec, so decode via CPython's ASCII fast path.
+    return {
+        m.group(1).decode("ascii").lower(): m.group(2).decode("ascii", "ignore").strip()
+        for m in _TAG_FINDITER(header_value)
+    }
+
+
+def _iter_unfolded_headers(blob: bytes) -> Iterator[Tuple[bytes, bytes]]:
+    # Yields (lowercased-name, value) with continuation lines already
+    # unfolded, so each header is assembled exactly once with no second
+    # re.sub pass over the value.
+    name: Optional[bytes] = None
+    value_lines: List[bytes] = []
+
+    for line in _LINE_SPLIT(blob):
+        if line.startswith((b" ", b"\t")):
+            if name is not None:
+                value_lines.append(line.lstrip(b" \t"))
+            continue
+
+        if name is not None:
+            yield name, b" ".join(value_lines).strip()
+            name = None
+            value_lines = []
+
+        sep = line.find(b":")
+        if sep == -1:
+            continue
+
+        name = line[:sep].strip().lower()
+        value_lines.append(line[sep + 1:])
+
+    if name is not None:
+        yield name, b" ".join(value_lines).strip()
+
+
+def _extract_arc_info(headers_blob: bytes) -> Dict:
+    arc_seal = None
+    arc_auth = None
+
+    for name, value in _iter_unfolded_headers(headers_blob):
+        if name == b"arc-seal":
+            if arc_seal is None:
+                arc_seal = value
+
+        elif name == b"arc-authentication-results":
+            if arc_auth is None:
+                arc_auth = value
+
+    return _build_arc_info(arc_seal, arc_auth)
+
+
+def _extract_dkim_signatures(headers_blob: bytes) -> List[Dict]:
+    signatures: List[Dict] = []
+
+    for name, value in _iter_unfolded_headers(headers_blob):
+        if name != b"dkim-signature":
+            continue
+
+        tags = _parse_dkim_tags(value)
+
+        if "d" not in tags or "s" not in tags:
+            continue
+
+        signatures.append({
+            "domain": tags["d"].lower(),
+            "selector": tags["s"],
+            "algorithm": tags.get("a"),
+            "canonicalization": tags.get("c"),
+            "raw": value,
+        })
+
+    return signatures
+
+
+def _decode_tag(value: Optional[bytes]) -> Optional[str]:
+    if value is None:
+        return None
+    return value.decode(errors="ignore").strip()
+
+
+def _verify_dkim(raw_email: bytes) -> Dict:
+    try:
+        d = dkim.DKIM(raw_email)
+        sig_headers = [v for n, v in d.headers if n.lower() == b"dkim-signature"]
+    except dkim.DKIMException as e:
+        return {
+            "dkim_present": True,
+            "dkim_result": "PERMERROR",
+            "dkim_valid": False,
+            "dkim_signatures": _extract_dkim_signatures(bytes(header_view(raw_email))),
+            "error": str(e),
+        }
+
+    signatures: List[Dict] = []
+    valid = False
+    bh_mismatch = False
+    temp_error: Optional[str] = None
+    perm_error: Optional[str] = None
+    body_hash_cache: Dict = {}
+
+    for idx, raw_header in enumerate(sig_headers):
+        # Errors are confined to the signature that raised them; a
+        # malformed or timed-out signature must not stop a later one
+        # from verifying.
+        try:
+            prep = d.verify_headerprep(idx)
+            if not prep:
+                continue
+            sig, include_headers, sigheaders = prep
+
+            # The body hash is computed once per (c=, a=, l=) combination;
+            # signatures whose bh= cannot match skip DNS and RSA entirely.
+            if _body_hash_matches(d.body, sig, body_hash_cache):
+                sig_valid = bool(
+                    d.verify_sig(sig, include_headers, sigheaders[idx], dkim.get_txt)
+                )
+            else:
+                sig_valid = False
+                bh_mismatch = True
+        except dkim.DnsTimeoutError as e:
+            temp_error = str(e)
+            continue
+        except dkim.DKIMException as e:
+            perm_error = str(e)
+            continue
+
+        valid = valid or sig_valid
+
+        if b"d" not in sig or b"s" not in sig:
+            continue
+
+        signatures.append({
+            "domain": _decode_tag(sig[b"d"]).lower(),
+            "selector": _decode_tag(sig[b"s"]),
+            "algorithm": _decode_tag(sig.get(b"a")),
+            "canonicalization": _decode_tag(sig.get(b"c")),
+            "raw": raw_header,
+        })
+
+    error: Optional[str] = None
+    if valid:
+        dkim_result = "PASS"
+    elif temp_error is not None:
+        dkim_result = "TEMPERROR"
+        error = temp_error
+    elif bh_mismatch:
+        # A modified body is the canonical dkim=fail case (RFC 6376),
+        # and dkim.verify reports it as a plain False.
+        dkim_result = "FAIL"
+        error = "body hash mismatch"
+    elif perm_error is not None:
+        dkim_result = "PERMERROR"
+        error = perm_error
+    else:
+        dkim_result = "FAIL"
+
+    result = {
+        "dkim_present": True,
+        "dkim_result": dkim_result,
+        "dkim_valid": valid,
+        "dkim_signatures": signatures,
+    }
+    if error is not None:
+        result["error"] = error
+    return result
+
+
+def _build_arc_info(arc_seal: Optional[bytes], arc_auth: Optional[bytes]) -> Dict:
+    if not arc_seal:
+        return {"arc_present": False}
+
+    arc_seal = arc_seal.decode(errors="ignore")
+
+    signer = None
+    m = _ARC_SIGNER_SEARCH(arc_seal)
+    if m:
+        signer = m.group(1)
+
+    arc_auth_value = None
+    if arc_auth:
+        arc_auth_value = arc_auth.decode(errors="ignore")
+
+    return {
+        "arc_present": True,
+        "arc_signer": signer,
+        "arc_authentication_results": arc_auth_value,
+        "arc_note": (
+            "ARC indicates the message was authenticated by an upstream receiver. "
+            "DKIM verification may fail locally due to header modifications. "
+            "ARC is informational and not cryptographically re-verified."
+        ),
+    }
+
+
+def _select_dkim_for_dmarc(
+    signatures: List[Dict],
+    header_from_domain: Optional[str],
+) -> Optional[str]:
+
+    if not signatures:
+        return None
+
+    if header_from_domain:
+        sig_domains = {sig["domain"] for sig in signatures}
+
+        # Walk the From: domain from most to least specific (a.b.c, b.c,
+        # c) against the signature-domain set, instead of an O(N*M)
+        # scan re-concatenating "." + d per signature.
+        candidate = header_from_domain.lower()
+        while candidate:
+            if candidate in sig_domains:
+                return candidate
+            dot = candidate.find(".")
+            if dot == -1:
+                break
+            candidate = candidate[dot + 1:]
+
+    return signatures[0]["domain"]
+
+
+def check_dkim(
+    raw_email: bytes,
+    header_from_domain: Optional[str] = None,
+) -> Dict:
+
+    if isinstance(raw_email, str):
+        raw_email = raw_email.encode(errors="ignore")
+
+    verification = _verify_dkim(raw_email)
+    signatures = verification["dkim_signatures"]
+    arc_info = _extract_arc_info(bytes(header_view(raw_email)))
+
+    dkim_domain = _select_dkim_for_dmarc(
+        signatures,
+        header_from_domain,
+    )
+
+    verification.update({
+        "dkim_domain": dkim_domain,
+        "dkim_aligned": False,
+        "dkim_signatures_found": len(signatures),
+        "arc": arc_info,
+    })
+
+    return verification
+
+
+# Static branch prefixes for the diagnostic trees; concatenating onto
+# these skips the f-string format machinery per line.
+_PFX_ITEM = " ├─ "
+_PFX_LAST = " └─ "
+_PFX_SUB = " │  ├─ "
+_PFX_SUB_LAST = " │  └─ "
+_PFX_SIG = " │  │  ├─ "
+_PFX_SIG_LAST = " │  │  └─ "
+
+
+def build_dkim_tree(
+    dkim_result: Dict,
+    header_from_domain: Optional[str],
+) -> List[str]:
+
+    tree = []
+    tree.append("DKIM Verification")
+
+    if not dkim_result.get("dkim_present"):
+        tree.append(_PFX_ITEM + "DKIM-Signature present: NO")
+        tree.append(_PFX_LAST + "DKIM RESULT → NONE")
+        return tree
+
+    result = dkim_result["dkim_result"]
+
+    tree.append(
+        _PFX_ITEM + "DKIM-Signatures found: "
+        + str(dkim_result["dkim_signatures_found"])
+    )
+
+    for idx, sig in enumerate(dkim_result.get("dkim_signatures", []), 1):
+        tree.append(_PFX_SUB + "Signature #" + str(idx))
+        tree.append(_PFX_SIG + "d = " + sig["domain"])
+        tree.append(_PFX_SIG + "s = " + sig["selector"])
+        tree.append(_PFX_SIG + "algorithm = " + str(sig.get("algorithm")))
+        tree.append(_PFX_SIG_LAST + "canonicalization = " + str(sig.get("canonicalization")))
+
+    tree.append(_PFX_ITEM + "Cryptographic verification")
+    tree.append(_PFX_SUB_LAST + "Result → " + result)
+
+    arc = dkim_result.get("arc", {})
+    if arc.get("arc_present"):
+        tree.append(_PFX_ITEM + "ARC detected")
+        tree.append(_PFX_SUB + "ARC signer → " + str(arc.get("arc_signer")))
+        tree.append(_PFX_SUB_LAST + "Note → Message authenticated upstream (ARC is informational)")
+
+    if header_from_domain:
+        tree.append(_PFX_ITEM + "Header-From domain = " + header_from_domain)
+        tree.append(_PFX_ITEM + "DKIM domain selection for DMARC")
+
+        if dkim_result.get("dkim_domain"):
+            tree.append(_PFX_SUB_LAST + "Selected DKIM domain → " + dkim_result["dkim_domain"])
+        else:
+            tree.append(_PFX_SUB_LAST + "No DKIM domain usable for DMARC")
+
+    tree.append(_PFX_LAST + "DKIM FINAL RESULT → " + result)
+
+    return tree
+
+
+def build_dkim_tree_str(
+    dkim_result: Dict,
+    header_from_domain: Optional[str],
+) -> str:
+    """Single pre-joined text blob, for callers that emit the tree as one
+    string instead of iterating the line list."""
+    return "\n".join(build_dkim_tree(dkim_result, header_from_domain))
@@ -1,15 +1,69 @@
-import dns.resolver
-import hashlib
-from typing import Dict, List, Optional
-from publicsuffix2 import get_sld
+import dns.asyncresolver
+import re
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from publicsuffixlist import PublicSuffixList
 
 
-_resolver = dns.resolver.Resolver()
+_resolver = dns.asyncresolver.Resolver()
 _resolver.timeout = 2
 _resolver.lifetime = 4
 
-
-def fetch_dmarc_record(domain: str) -> Dict:
+_TXT_CACHE_MAX = 1024
+_TXT_TTL_MAX = 300
+_TXT_NEGATIVE_TTL = 30
+_TXT_ERROR_LIMIT = 2
+
+_txt_cache: Dict[Tuple[str, str], Tuple[float, Optional[List]]] = {}
+_txt_failures: Dict[Tuple[str, str], int] = {}
+_txt_cache_lock = threading.Lock()
+
+
+async def _resolve_txt_cached(name: str) -> Optional[List]:
+    key = (name, "TXT")
+    now = time.monotonic()
+
+    with _txt_cache_lock:
+        hit = _txt_cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+
+    try:
+        answers = await _resolver.resolve(name, "TXT")
+    except Exception:
+        with _txt_cache_lock:
+            failures = _txt_failures.get(key, 0) + 1
+            if failures >= _TXT_ERROR_LIMIT:
+                # The negative cache entry takes over; the counter is
+                # done and must not linger.
+                _txt_failures.pop(key, None)
+                if len(_txt_cache) >= _TXT_CACHE_MAX:
+                    _txt_cache.pop(next(iter(_txt_cache)))
+                _txt_cache[key] = (now + _TXT_NEGATIVE_TTL, None)
+            else:
+                # Same bound as _txt_cache; callers supply arbitrary
+                # domains, so unresolvable names must not accrete.
+                if len(_txt_failures) >= _TXT_CACHE_MAX:
+                    _txt_failures.pop(next(iter(_txt_failures)))
+                _txt_failures[key] = failures
+        return None
+
+    ttl = min(getattr(answers.rrset, "ttl", _TXT_TTL_MAX), _TXT_TTL_MAX)
+    records = list(answers)
+
+    with _txt_cache_lock:
+        _txt_failures.pop(key, None)
+        if len(_txt_cache) >= _TXT_CACHE_MAX:
+            _txt_cache.pop(next(iter(_txt_cache)))
+        _txt_cache[key] = (now + ttl, records)
+
+    return records
+
+
+async def fetch_dmarc_record(domain: str) -> Dict:
     tried = []
     records = []
 
@@ -18,17 +72,14 @@ def fetch_dmarc_record(domain: str) -> Dict:
             continue
         tried.append(target)
 
-        try:
-            answers = _resolver.resolve(f"_dmarc.{target}", "TXT")
-            for rdata in answers:
-                record = "".join(
-                    p.decode() if isinstance(p, bytes) else p
-                    for p in rdata.strings
-                )
-                if record.lower().startswith("v=dmarc1"):
-                    records.append((target, record))
-        except Exception:
-            pass
+        answers = await _resolve_txt_cached(f"_dmarc.{target}")
+        for rdata in answers or ():
+            record = "".join(
+                p.decode() if isinstance(p, bytes) else p
+                for p in rdata.strings
+            )
+            if record.lower().startswith("v=dmarc1"):
+                records.append((target, record))
 
     if len(records) == 0:
         return {"found": False}
@@ -46,32 +97,44 @@ def fetch_dmarc_record(domain: str) -> Dict:
         "record": record,
     }
 
+_DMARC_KV_FINDITER = re.compile(r"\s*([a-zA-Z]+)\s*=\s*([^;]*)").finditer
+
+
 def parse_dmarc_record(record: str) -> Dict:
-    tags = {}
+    tags = {
+        m.group(1).lower(): m.group(2).strip().lower()
+        for m in _DMARC_KV_FINDITER(record)
+    }
 
-    for part in record.split(";"):
-        part = part.strip()
-        if "=" in part:
-            k, v = part.split("=", 1)
-            tags[k.lower()] = v.lower()
+    try:
+        pct = int(tags["pct"])
+    except (KeyError, ValueError):
+        pct = 100
 
     return {
         "p": tags.get("p", "none"),
         "sp": tags.get("sp"),
         "aspf": tags.get("aspf", "r"),
         "adkim": tags.get("adkim", "r"),
-        "pct": int(tags.get("pct", "100")),
+        "pct": pct,
     }
 
 
 
+# Loads the bundled list once at import; lookups are dict-based suffix
+# matching rather than publicsuffix2's per-label trie walk.
+_psl = PublicSuffixList()
+
+
+@lru_cache(maxsize=4096)
 def get_org_domain(domain: str) -> str:
-    return get_sld(domain) or domain
+    return _psl.privatesuffix(domain) or domain
 
 
 def is_aligned(
     auth_domain: Optional[str],
     from_domain: str,
+    from_org: str,
     mode: str,
 ) -> bool:
     if not auth_domain:
@@ -80,16 +143,17 @@ def is_aligned(
     if mode == "s":
         return auth_domain == from_domain
 
-    return get_org_domain(auth_domain) == get_org_domain(from_domain)
+    return get_org_domain(auth_domain) == from_org
 
 
 def pct_allows_enforcement(domain: str, pct: int) -> bool:
-    h = hashlib.sha256(domain.encode()).hexdigest()
-    bucket = int(h[:4], 16) % 100 + 1
+    # Deterministic sampling bucket, not a security primitive: pct= is a
+    # traffic-sampling knob, so a CRC is plenty and far cheaper than SHA-256.
+    bucket = zlib.crc32(domain.encode()) % 100 + 1
     return bucket <= pct
 
 
-def evaluate_dmarc(
+async def evaluate_dmarc(
     *,
     header_from_domain: str,
     spf_result: str,
@@ -98,7 +162,7 @@ def evaluate_dmarc(
     dkim_domain: Optional[str],
 ) -> Dict:
 
-    lookup = fetch_dmarc_record(header_from_domain)
+    lookup = await fetch_dmarc_record(header_from_domain)
 
     if not lookup.get("found"):
         return {
@@ -124,14 +188,18 @@ def evaluate_dmarc(
     if lookup["location"] != header_from_domain and tags["sp"]:
         policy = tags["sp"]
 
+    # Computed once per evaluation; relaxed-mode alignment for both SPF
+    # and DKIM compares against the same From: org domain.
+    from_org = get_org_domain(header_from_domain)
+
     spf_aligned = (
         spf_result == "PASS"
-        and is_aligned(spf_domain, header_from_domain, tags["aspf"])
+        and is_aligned(spf_domain, header_from_domain, from_org, tags["aspf"])
     )
 
     dkim_aligned = (
         dkim_result == "PASS"
-        and is_aligned(dkim_domain, header_from_domain, tags["adkim"])
+        and is_aligned(dkim_domain, header_from_domain, from_org, tags["adkim"])
     )
 
     dmarc_pass = spf_aligned or dkim_aligned
@@ -164,39 +232,55 @@ def evaluate_dmarc(
     }
 
 
+# Static branch prefixes, shared by every build_dmarc_tree call;
+# concatenation onto them avoids per-line f-string formatting.
+_PFX_ITEM = " ├─ "
+_PFX_LAST = " └─ "
+_PFX_SUB = " │  ├─ "
+_PFX_SUB_LAST = " │  └─ "
+
+
 def build_dmarc_tree(dmarc: Dict) -> List[str]:
     tree = []
     tree.append("DMARC Evaluation")
 
     if not dmarc.get("dmarc_present"):
-        tree.append(" ├─ DMARC record present: NO")
-        tree.append(" └─ DMARC RESULT → NONE (policy not enforced)")
+        tree.append(_PFX_ITEM + "DMARC record present: NO")
+        tree.append(_PFX_LAST + "DMARC RESULT → NONE (policy not enforced)")
         return tree
 
-    tree.append(f" ├─ DMARC record found at _dmarc")
-    tree.append(f" │  ├─ policy (p) = {dmarc['policy']}")
-    tree.append(f" │  ├─ aspf = {dmarc['aspf']}")
-    tree.append(f" │  ├─ adkim = {dmarc['adkim']}")
-    tree.append(f" │  └─ pct = {dmarc['pct']}")
+    result = dmarc["dmarc_result"]
 
-    tree.append(" ├─ SPF alignment check")
-    tree.append(
-        f" │  └─ SPF aligned → {'PASS' if dmarc['spf_aligned'] else 'FAIL'}"
-    )
+    tree.append(_PFX_ITEM + "DMARC record found at _dmarc")
+    tree.append(_PFX_SUB + "policy (p) = " + dmarc["policy"])
+    tree.append(_PFX_SUB + "aspf = " + dmarc["aspf"])
+    tree.append(_PFX_SUB + "adkim = " + dmarc["adkim"])
+    tree.append(_PFX_SUB_LAST + "pct = " + str(dmarc["pct"]))
 
-    tree.append(" ├─ DKIM alignment check")
+    tree.append(_PFX_ITEM + "SPF alignment check")
     tree.append(
-        f" │  └─ DKIM aligned → {'PASS' if dmarc['dkim_aligned'] else 'FAIL'}"
+        _PFX_SUB_LAST + "SPF aligned → "
+        + ("PASS" if dmarc["spf_aligned"] else "FAIL")
     )
 
-    tree.append(" ├─ DMARC policy evaluation")
+    tree.append(_PFX_ITEM + "DKIM alignment check")
     tree.append(
-        f" │  └─ SPF OR DKIM aligned → {dmarc['dmarc_result']}"
+        _PFX_SUB_LAST + "DKIM aligned → "
+        + ("PASS" if dmarc["dkim_aligned"] else "FAIL")
     )
 
-    tree.append(" ├─ Policy enforcement decision")
-    tree.append(f" │  └─ Enforcement → {dmarc['enforcement']}")
+    tree.append(_PFX_ITEM + "DMARC policy evaluation")
+    tree.append(_PFX_SUB_LAST + "SPF OR DKIM aligned → " + result)
 
-    tree.append(f" └─ DMARC FINAL RESULT → {dmarc['dmarc_result']}")
+    tree.append(_PFX_ITEM + "Policy enforcement decision")
+    tree.append(_PFX_SUB_LAST + "Enforcement → " + dmarc["enforcement"])
+
+    tree.append(_PFX_LAST + "DMARC FINAL RESULT → " + result)
 
     return tree
+
+
+def build_dmarc_tree_str(dmarc: Dict) -> str:
+    """Single pre-joined text blob, for callers that emit the tree as one
+    string instead of iterating the line list."""
+    return "\n".join(build_dmarc_tree(dmarc))
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Optional
 from mail_engine import run_mail_check
 
@@ -46,13 +47,13 @@ def main():
             print("Failed to read EML file:", str(e))
 
 
-    result = run_mail_check(
+    result = asyncio.run(run_mail_check(
         domain=domain,
         sender_ip=sender_ip,
         mail_from=mail_from,
         helo=helo,
         raw_email=raw_email,
-    )
+    ))
 
     print("\n========== SPF RESULT ==========\n")
     spf = result["spf"]
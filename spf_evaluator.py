@@ -1,8 +1,17 @@
+import asyncio
 import re
 import ipaddress
+import dns.asyncresolver
+import dns.exception
+import dns.message
+import dns.name
 import dns.resolver
 import dns.reversename
+import pytricia
+import sys
+import threading
 import time
+from dataclasses import dataclass
 from typing import Dict, List, Optional, Set, Tuple
 
 from spf_extractor import fetch_spf, parse_mechanisms, normalize_domain
@@ -10,29 +19,94 @@ from spf_extractor import fetch_spf, parse_mechanisms, normalize_domain
 MAX_SPF_LOOKUPS = 10
 MAX_RECURSION_DEPTH = 20
 
-
-def cached_resolve(domain: str, rtype: str, trace: Optional[Dict], dns_cache: Dict[Tuple[str, str], List]) -> List:
-    key = (rtype, domain)
-    if key in dns_cache:
-        if trace:
-            trace["steps"].append(f"DNS cache hit: {rtype} {domain}")
-        return dns_cache[key]
+_resolver = dns.asyncresolver.Resolver()
+# Advertise a 4096-byte UDP payload so large SPF answers arrive in one
+# datagram instead of a truncated reply plus a TCP retry; keep per-try
+# waits short and bound the whole query at 3s so one slow nameserver
+# cannot stall an evaluation.
+_resolver.use_edns(0, 0, 4096)
+_resolver.timeout = 1.0
+_resolver.lifetime = 3.0
+
+# Interned record-type keys; the other half of each cache key is the
+# wire-format name, so key comparison is pointer-compare plus a bytes
+# hash.
+_A = sys.intern("A")
+_AAAA = sys.intern("AAAA")
+_MX = sys.intern("MX")
+_PTR = sys.intern("PTR")
+
+# Answers persist across evaluations instead of dying with each
+# per-call state dict, TTL-capped so repeated checks against the same
+# sender domain stop re-paying every round trip. Same shape as the
+# DMARC TXT cache.
+_DNS_CACHE_MAX = 2048
+_DNS_TTL_MAX = 300
+_DNS_NEGATIVE_TTL = 30
+
+_dns_cache: Dict[Tuple[str, bytes], Tuple[float, List]] = {}
+_dns_cache_lock = threading.Lock()
+
+# Definitive or already-waited-out failures; a TCP retry cannot turn
+# these into answers, so they go straight to the negative cache.
+_NO_RETRY_ERRORS = (
+    dns.resolver.NXDOMAIN,
+    dns.resolver.NoAnswer,
+    dns.exception.Timeout,
+)
+
+
+async def cached_resolve(qname: dns.name.Name, rtype: str, trace: Optional[Dict]) -> List:
+    # The name is parsed to a dns.name.Name once by the caller and
+    # handed to dnspython as-is; the cache keys on its wire form, which
+    # is already case-folded and hashes faster than the text form.
+    key = (rtype, qname.to_wire())
+    now = time.monotonic()
+
+    with _dns_cache_lock:
+        hit = _dns_cache.get(key)
+        if hit and hit[0] > now:
+            if trace:
+                trace["steps"].append(
+                    f"DNS cache hit: {rtype} {qname.to_text(omit_final_dot=True)}"
+                )
+            return hit[1]
 
     if trace:
-        trace["steps"].append(f"DNS lookup: {rtype} {domain}")
+        trace["steps"].append(f"DNS lookup: {rtype} {qname.to_text(omit_final_dot=True)}")
 
     try:
-        answers = dns.resolver.resolve(domain, rtype)
-    except Exception:
+        answers = await _resolver.resolve(qname, rtype)
+    except _NO_RETRY_ERRORS:
+        answers = None
+    except dns.message.Truncated:
+        # With the 4096-byte EDNS0 buffer truncation is rare; only an
+        # actually truncated reply earns the TCP round trip.
         try:
-            answers = dns.resolver.resolve(domain, rtype, tcp=True)
+            answers = await _resolver.resolve(qname, rtype, tcp=True)
             if trace:
-                trace["steps"].append(f"DNS lookup (TCP fallback): {rtype} {domain}")
+                trace["steps"].append(
+                    f"DNS lookup (TCP fallback): {rtype} {qname.to_text(omit_final_dot=True)}"
+                )
         except Exception:
-            answers = []
+            answers = None
+    except Exception:
+        answers = None
+
+    if answers is None:
+        records: List = []
+        ttl = _DNS_NEGATIVE_TTL
+    else:
+        records = list(answers)
+        rrset_ttl = getattr(getattr(answers, "rrset", None), "ttl", None)
+        ttl = _DNS_TTL_MAX if rrset_ttl is None else min(rrset_ttl, _DNS_TTL_MAX)
 
-    dns_cache[key] = list(answers)
-    return dns_cache[key]
+    with _dns_cache_lock:
+        if len(_dns_cache) >= _DNS_CACHE_MAX:
+            _dns_cache.pop(next(iter(_dns_cache)))
+        _dns_cache[key] = (now + ttl, records)
+
+    return records
 
 
 
@@ -47,28 +121,199 @@ def split_qualifier(mech: str) -> Tuple[str, str]:
     return "+", mech
 
 
+# Mechanism kinds; one dict lookup on the leading token replaces the
+# dozen startswith tests the evaluation loop used to run per mechanism.
+(
+    _K_IP4,
+    _K_IP6,
+    _K_INCLUDE,
+    _K_A,
+    _K_MX,
+    _K_EXISTS,
+    _K_PTR,
+    _K_ALL,
+    _K_REDIRECT,
+    _K_EXP,
+    _K_UNKNOWN,
+) = range(11)
+
+_KIND_BY_TOKEN = {
+    "ip4": _K_IP4,
+    "ip6": _K_IP6,
+    "include": _K_INCLUDE,
+    "a": _K_A,
+    "mx": _K_MX,
+    "exists": _K_EXISTS,
+    "ptr": _K_PTR,
+    "all": _K_ALL,
+    "redirect": _K_REDIRECT,
+    "exp": _K_EXP,
+}
+
+# Separators each kind accepts between token and argument; anything
+# else demotes the mechanism to unknown, matching the old prefix tests.
+_KIND_SEPS = {
+    _K_IP4: (":",),
+    _K_IP6: (":",),
+    _K_INCLUDE: (":",),
+    _K_A: ("", ":", "/"),
+    _K_MX: ("", ":", "/"),
+    _K_EXISTS: (":",),
+    _K_PTR: ("", ":"),
+    _K_ALL: ("",),
+    _K_REDIRECT: ("=",),
+    _K_EXP: ("=",),
+}
+
+
+def _classify(raw_mech: str) -> Tuple[str, int, str]:
+    qualifier, mech = split_qualifier(raw_mech)
+
+    head = mech
+    sep = ""
+    for i, ch in enumerate(mech):
+        if ch in ":/=":
+            head = mech[:i]
+            sep = ch
+            break
+
+    kind = _KIND_BY_TOKEN.get(head, _K_UNKNOWN)
+    if kind != _K_UNKNOWN and sep not in _KIND_SEPS[kind]:
+        kind = _K_UNKNOWN
+
+    return qualifier, kind, mech
+
+
+@dataclass(slots=True)
+class ParsedMech:
+    raw: str
+    qualifier: str
+    kind: int
+    # Unexpanded argument: domain-spec template, CIDR text for ip4/ip6,
+    # or None when the mechanism has no argument.
+    arg: Optional[str]
+    cidr: Optional[int]
+
+
+def parse_record(mechanisms: List[str]) -> List[ParsedMech]:
+    """Parse each raw mechanism exactly once; the evaluation loop then
+    works on fields instead of re-slicing the token per branch."""
+    parsed = []
+
+    for raw_mech in mechanisms:
+        qualifier, kind, mech = _classify(raw_mech)
+        arg: Optional[str] = None
+        cidr: Optional[int] = None
+
+        if kind == _K_A or kind == _K_MX:
+            body = mech[1:] if kind == _K_A else mech[2:]
+            if body.startswith(":"):
+                rest = body[1:]
+                if "/" in rest:
+                    arg, cidr_part = rest.split("/", 1)
+                    try:
+                        cidr = int(cidr_part)
+                    except ValueError:
+                        cidr = None
+                else:
+                    arg = rest
+            elif body.startswith("/"):
+                try:
+                    cidr = int(body[1:])
+                except ValueError:
+                    pass
+
+        elif kind in (_K_IP4, _K_IP6, _K_INCLUDE, _K_EXISTS):
+            arg = mech.split(":", 1)[1]
+
+        elif kind in (_K_REDIRECT, _K_EXP):
+            arg = mech.split("=", 1)[1]
+
+        elif kind == _K_PTR and ":" in mech:
+            arg = mech.split(":", 1)[1]
+
+        parsed.append(ParsedMech(raw_mech, qualifier, kind, arg, cidr))
+
+    return parsed
+
+
+# Classification is a pure function of the record text, so parsed
+# mechanism lists are shared across evaluations -- keyed by the raw
+# record rather than the domain, different domains publishing identical
+# text share one entry. LRU-bounded; hits refresh recency by
+# re-inserting, eviction drops the oldest key. The cached lists are
+# never mutated by the walk.
+_PARSED_SPF_MAX = 1024
+
+_parsed_spf: Dict[str, List[ParsedMech]] = {}
+_parsed_spf_lock = threading.Lock()
+
+
+def _parsed_record(spf_record: str) -> List[ParsedMech]:
+    with _parsed_spf_lock:
+        parsed = _parsed_spf.get(spf_record)
+        if parsed is not None:
+            _parsed_spf[spf_record] = _parsed_spf.pop(spf_record)
+            return parsed
+
+    parsed = parse_record(parse_mechanisms(spf_record))
+
+    with _parsed_spf_lock:
+        if len(_parsed_spf) >= _PARSED_SPF_MAX:
+            _parsed_spf.pop(next(iter(_parsed_spf)))
+        _parsed_spf[spf_record] = parsed
+
+    return parsed
+
+
 def result_from_qualifier(q: str) -> str:
     return {"+": "PASS", "-": "FAIL", "~": "SOFTFAIL", "?": "NEUTRAL"}.get(q, "NEUTRAL")
 
 
-def resolve_a_aaaa(domain: str, trace: Optional[Dict], dns_cache: Dict) -> List[ipaddress.IPv4Address | ipaddress.IPv6Address]:
+async def resolve_a_aaaa(domain: str, trace: Optional[Dict], ip_version: Optional[int] = None) -> List[ipaddress.IPv4Address | ipaddress.IPv6Address]:
+    # Parse the target to a dns.name.Name once so the A and AAAA
+    # queries (and their cache keys) share the canonicalization.
+    try:
+        qname = dns.name.from_text(domain)
+    except Exception:
+        return []
+    # Only the sender's address family can ever match, so skip the other
+    # family's query when the caller knows the version. When both are
+    # needed they are independent queries; overlap their round trips
+    # instead of paying them back to back.
+    if ip_version == 4:
+        answer_sets = [(ipaddress.IPv4Address, await cached_resolve(qname, _A, trace))]
+    elif ip_version == 6:
+        answer_sets = [(ipaddress.IPv6Address, await cached_resolve(qname, _AAAA, trace))]
+    else:
+        a_answers, aaaa_answers = await asyncio.gather(
+            cached_resolve(qname, _A, trace),
+            cached_resolve(qname, _AAAA, trace),
+        )
+        answer_sets = [
+            (ipaddress.IPv4Address, a_answers),
+            (ipaddress.IPv6Address, aaaa_answers),
+        ]
     ips = []
-    for r in cached_resolve(domain, "A", trace, dns_cache):
-        try:
-            ips.append(ipaddress.ip_address(r.to_text()))
-        except Exception:
-            pass
-    for r in cached_resolve(domain, "AAAA", trace, dns_cache):
-        try:
-            ips.append(ipaddress.ip_address(r.to_text()))
-        except Exception:
-            pass
+    # The query type fixes the family, so build the concrete address
+    # class from rdata.address directly instead of round-tripping
+    # through to_text() and ip_address()'s family sniffing.
+    for factory, answers in answer_sets:
+        for r in answers:
+            try:
+                ips.append(factory(r.address))
+            except Exception:
+                pass
     return ips
 
 
-def resolve_mx(domain: str, trace: Optional[Dict], dns_cache: Dict) -> List[str]:
+async def resolve_mx(domain: str, trace: Optional[Dict]) -> List[str]:
+    try:
+        qname = dns.name.from_text(domain)
+    except Exception:
+        return []
     hosts = []
-    for r in cached_resolve(domain, "MX", trace, dns_cache):
+    for r in await cached_resolve(qname, _MX, trace):
         try:
             hosts.append(str(r.exchange).rstrip("."))
         except Exception:
@@ -76,11 +321,12 @@ def resolve_mx(domain: str, trace: Optional[Dict], dns_cache: Dict) -> List[str]
     return hosts
 
 
-def resolve_ptr(ip_obj: ipaddress.IPv4Address | ipaddress.IPv6Address, trace: Optional[Dict], dns_cache: Dict) -> List[str]:
+async def resolve_ptr(ip_obj: ipaddress.IPv4Address | ipaddress.IPv6Address, trace: Optional[Dict]) -> List[str]:
     names = []
     try:
+        # from_address already yields a dns.name.Name; no text round trip.
         rev_name = dns.reversename.from_address(str(ip_obj))
-        for r in cached_resolve(str(rev_name), "PTR", trace, dns_cache):
+        for r in await cached_resolve(rev_name, _PTR, trace):
             try:
                 names.append(str(r.target).rstrip("."))
             except Exception:
@@ -90,21 +336,39 @@ def resolve_ptr(ip_obj: ipaddress.IPv4Address | ipaddress.IPv6Address, trace: Op
     return names
 
 
-def ip_matches(addr: ipaddress.IPv4Address | ipaddress.IPv6Address, cidr: Optional[int], ip_obj: ipaddress.IPv4Address | ipaddress.IPv6Address) -> bool:
-    try:
-        if cidr is not None:
-            length = cidr
-        else:
-            length = 32 if addr.version == 4 else 128
-        net = ipaddress.ip_network(f"{addr}/{length}", strict=False)
-        return ip_obj in net
-    except Exception:
-        return False
+def _insert_cidr(trie, cidr: str, value, max_len: int) -> None:
+    # pytricia silently accepts out-of-range prefix lengths, so validate
+    # the mask here to keep ip_network's strictness.
+    if "/" in cidr:
+        length = int(cidr.rsplit("/", 1)[1])
+        if not 0 <= length <= max_len:
+            raise ValueError(f"invalid prefix length: {cidr}")
+    trie[cidr] = value
+
+
+def addrs_match(addrs: List[ipaddress.IPv4Address | ipaddress.IPv6Address], cidr: Optional[int], ip_obj: ipaddress.IPv4Address | ipaddress.IPv6Address) -> bool:
+    # Batch containment: one Patricia trie populated in C and a single
+    # longest-prefix lookup, instead of building an ip_network object
+    # per resolved address.
+    version = ip_obj.version
+    default_len = 32 if version == 4 else 128
+    length = cidr if cidr is not None else default_len
+    trie = None
+    for addr in addrs:
+        if addr.version != version:
+            continue
+        if trie is None:
+            trie = pytricia.PyTricia(default_len)
+        try:
+            _insert_cidr(trie, f"{addr}/{length}", True, default_len)
+        except Exception:
+            continue
+    return trie is not None and str(ip_obj) in trie
 
 
-def check_exists(domain: str, trace: Optional[Dict], dns_cache: Dict) -> bool:
+async def check_exists(domain: str, trace: Optional[Dict]) -> bool:
     log(trace, f"EXISTS check: {domain}")
-    return len(resolve_a_aaaa(domain, trace, dns_cache)) > 0
+    return len(await resolve_a_aaaa(domain, trace)) > 0
 
 
 def _split_mail_from(mail_from: Optional[str]) -> Tuple[str, str]:
@@ -117,6 +381,21 @@ def _split_mail_from(mail_from: Optional[str]) -> Tuple[str, str]:
     return mf, ""
 
 
+_MACRO_RE = re.compile(r"([A-Za-z])(\d+)?(r)?(.*)")
+
+# Split patterns keyed by delimiter set; re.escape plus an f-string
+# would otherwise rebuild the pattern string on every macro, defeating
+# re's internal cache fast path.
+_DELIM_SPLIT_CACHE: Dict[str, "re.Pattern[str]"] = {}
+
+
+def _delim_splitter(delims: str):
+    pattern = _DELIM_SPLIT_CACHE.get(delims)
+    if pattern is None:
+        pattern = _DELIM_SPLIT_CACHE[delims] = re.compile(f"[{re.escape(delims)}]+")
+    return pattern.split
+
+
 def expand_macros(
     template: str,
     ip: str,
@@ -127,11 +406,25 @@ def expand_macros(
     if not template:
         return template
 
+    # Most SPF records carry no macros at all; skip the scanner and the
+    # per-call setup entirely when the sigil is absent.
+    if "%" not in template:
+        return template
+
     local_part, sender_domain = _split_mail_from(mail_from)
     domain = normalize_domain(domain)
     helo = helo or ""
     ip_str = ip
 
+    # Parsed at most once per expansion instead of per macro letter.
+    ip_version: Optional[int] = None
+
+    def _ip_version() -> int:
+        nonlocal ip_version
+        if ip_version is None:
+            ip_version = ipaddress.ip_address(ip_str).version
+        return ip_version
+
     def value(letter: str) -> str:
         letter = letter.lower()
         mapping = {
@@ -144,17 +437,24 @@ def expand_macros(
             "c": ip_str,
             "r": domain,
             "t": str(int(time.time())),
-            "v": "in-addr" if ipaddress.ip_address(ip_str).version == 4 else "ip6",
+            "v": "in-addr" if _ip_version() == 4 else "ip6",
         }
         return mapping.get(letter, "")
 
     out = []
     i = 0
-    while i < len(template):
-        if template[i] != "%":
-            out.append(template[i])
-            i += 1
-            continue
+    n = len(template)
+    find = template.find
+    while i < n:
+        # Copy the literal run up to the next sigil in one C-level
+        # slice; the Python-level loop only steps once per macro.
+        j = find("%", i)
+        if j == -1:
+            out.append(template[i:])
+            break
+        if j > i:
+            out.append(template[i:j])
+            i = j
 
         if i + 1 < len(template):
             next_char = template[i + 1]
@@ -170,17 +470,17 @@ def expand_macros(
                 inner = template[i + 2 : end]
                 i = end + 1
 
-                m = re.match(r"([A-Za-z])(\d+)?(r)?(.*)", inner)
+                m = _MACRO_RE.match(inner)
                 if not m:
                     continue
                 letter, num_str, reverse, delims = m.groups()
                 raw = value(letter)
-                delims = delims or ("." if letter.lower() != "i" else ("." if ipaddress.ip_address(ip_str).version == 4 else ":"))
-                parts = re.split(f"[{re.escape(delims)}]+", raw) if raw else []
+                delims = delims or ("." if letter.lower() != "i" else ("." if _ip_version() == 4 else ":"))
+                parts = _delim_splitter(delims)(raw) if raw else []
                 if num_str:
                     try:
-                        n = int(num_str)
-                        parts = parts[-n:]
+                        count = int(num_str)
+                        parts = parts[-count:]
                     except ValueError:
                         pass
                 if reverse:
@@ -198,58 +498,30 @@ def expand_macros(
 
 
 
-def _parse_mechanism_target(
-    mech: str,
-    prefix: str,
-    default_domain: str,
+def _expand_target(
+    arg: Optional[str],
     ip: str,
+    default_domain: str,
     mail_from: Optional[str],
     helo: Optional[str],
-) -> Tuple[str, Optional[int]]:
-    body = mech[len(prefix) :]
-    target = default_domain
-    cidr: Optional[int] = None
-
-    if body.startswith(":"):
-        rest = body[1:]
-        if "/" in rest:
-            domain_part, cidr_part = rest.split("/", 1)
-            expanded = expand_macros(domain_part, ip, default_domain, mail_from, helo)
-            target = normalize_domain(expanded) if expanded else default_domain
-            try:
-                cidr = int(cidr_part)
-            except ValueError:
-                cidr = None
-        else:
-            expanded = expand_macros(rest, ip, default_domain, mail_from, helo)
-            target = normalize_domain(expanded) if expanded else default_domain
-    elif body.startswith("/"):
-        try:
-            cidr = int(body[1:])
-        except ValueError:
-            pass
-
-    return target, cidr
+) -> str:
+    if not arg:
+        return default_domain
+    expanded = expand_macros(arg, ip, default_domain, mail_from, helo)
+    return normalize_domain(expanded) if expanded else default_domain
 
 
-def evaluate_spf(
+async def _open_frame(
     domain: str,
-    ip: str,
-    state: Optional[Dict] = None,
-    trace: Optional[Dict] = None,
-    depth: int = 0,
-    mail_from: Optional[str] = None,
-    helo: Optional[str] = None,
-) -> str:
-    if trace is None:
-        trace = {"steps": [], "lookups": 0}
-    if state is None:
-        state = {
-            "seen": set(),
-            "spf_lookups": 0,
-            "dns_cache": {},
-        }
-
+    depth: int,
+    ip_obj: ipaddress.IPv4Address | ipaddress.IPv6Address,
+    state: Dict,
+    trace: Dict,
+) -> Dict | str:
+    """Per-domain setup for the iterative walk: loop/depth checks,
+    record fetch and parse, include prefetch. Returns a frame dict, or
+    a final result string when the domain resolves without walking any
+    mechanisms."""
     if depth > MAX_RECURSION_DEPTH:
         return "PERMERROR (recursion depth exceeded)"
 
@@ -260,153 +532,291 @@ def evaluate_spf(
     state["seen"].add(domain)
     log(trace, f"Evaluating SPF for domain: {domain}")
 
-    try:
-        ip_obj = ipaddress.ip_address(ip)
-    except ValueError:
-        return "PERMERROR (invalid IP address)"
-
-    spf_record = fetch_spf(domain, trace)
+    spf_record = await fetch_spf(domain, trace)
     if not spf_record:
         return "NONE"
     if spf_record.startswith("PERMERROR"):
         return spf_record
 
     log(trace, f"SPF record: {spf_record}")
-    mechanisms = parse_mechanisms(spf_record)
-
-    redirect_target: Optional[str] = None
-    exp_domain: Optional[str] = None
-    matched = False
-
-    for raw_mech in mechanisms:
-        if matched:
+    parsed = _parsed_record(spf_record)
+
+    # Literal ip4:/ip6: mechanisms cost no DNS, so when one matches the
+    # sender before anything that could match, error or spend lookup
+    # budget ahead of it, the answer is already decided -- skip the
+    # include prefetch and the walk entirely. The scan stops at the
+    # first such mechanism, so first-match order is preserved; a
+    # malformed literal falls through for the ordered walk to surface.
+    #
+    # The tries live on the frame, not the evaluation state: cumulative
+    # membership is only safe within one record, where any earlier
+    # matching literal would already have returned. Across an include
+    # boundary a child's non-PASS match is swallowed, so its prefixes
+    # must not leak into the parent's checks.
+    trie4 = pytricia.PyTricia(32)
+    trie6 = pytricia.PyTricia(128)
+    for p in parsed:
+        kind = p.kind
+        if kind == _K_IP4 or kind == _K_IP6:
+            version = 4 if kind == _K_IP4 else 6
+            trie = trie4 if version == 4 else trie6
+            try:
+                _insert_cidr(trie, p.arg, p.qualifier, 32 if version == 4 else 128)
+            except Exception:
+                break
+            if ip_obj.version == version and str(ip_obj) in trie:
+                log(trace, f"Checking mechanism: {p.raw}")
+                return result_from_qualifier(p.qualifier)
+        elif kind not in (_K_EXP, _K_UNKNOWN):
             break
 
-        qualifier, mech = split_qualifier(raw_mech)
-        log(trace, f"Checking mechanism: {raw_mech}")
-
-        # exp=
-        if mech.startswith("exp="):
-            expanded = expand_macros(mech[len("exp=") :], ip, domain, mail_from, helo)
-            exp_domain = normalize_domain(expanded)
+    # Warm the shared TXT cache for the record's include targets in one
+    # gather so sibling includes overlap their round trips. Only the
+    # cache is touched here: the lookup budget, loop detection and
+    # first-match short-circuiting all still run strictly in mechanism
+    # order, so results are identical to a serial walk. The set is
+    # capped at the remaining lookup budget, taken in mechanism order --
+    # the walk could never reach an include past that point, and a
+    # hostile record with hundreds of includes must not fan out more
+    # TXT queries than the budget allows.
+    remaining = MAX_SPF_LOOKUPS - state["spf_lookups"]
+    prefetch_targets: Dict[str, None] = {}
+    for p in parsed:
+        if len(prefetch_targets) >= remaining:
+            break
+        if p.kind == _K_INCLUDE and "%" not in p.arg:
+            target = normalize_domain(p.arg)
+            if target not in state["seen"]:
+                prefetch_targets[target] = None
+    if len(prefetch_targets) > 1:
+        await asyncio.gather(*(fetch_spf(t) for t in prefetch_targets))
+
+    return {
+        "domain": domain,
+        "parsed": parsed,
+        "idx": 0,
+        "exp_template": None,
+        "redirect_target": None,
+        "depth": depth,
+        "trie4": trie4,
+        "trie6": trie6,
+    }
+
+
+async def _walk_frame(
+    frame: Dict,
+    ip: str,
+    ip_obj: ipaddress.IPv4Address | ipaddress.IPv6Address,
+    state: Dict,
+    trace: Dict,
+    mail_from: Optional[str],
+    helo: Optional[str],
+) -> tuple:
+    """Advance a frame until it completes ("done", result), needs an
+    include sub-evaluation ("call", target, qualifier), or falls
+    through to its redirect ("redirect", target)."""
+    parsed = frame["parsed"]
+    domain = frame["domain"]
+
+    while frame["idx"] < len(parsed):
+        p = parsed[frame["idx"]]
+        frame["idx"] += 1
+
+        qualifier = p.qualifier
+        kind = p.kind
+        log(trace, f"Checking mechanism: {p.raw}")
+
+        # exp= -- the explanation only matters if the record ends in
+        # FAIL, so just remember the raw template; expansion and the
+        # TXT fetch happen under the `all` branch when they are needed.
+        if kind == _K_EXP:
+            frame["exp_template"] = p.arg
             continue
 
         # redirect=
-        if mech.startswith("redirect="):
+        if kind == _K_REDIRECT:
             state["spf_lookups"] += 1
             trace["lookups"] = state["spf_lookups"]
             if state["spf_lookups"] > MAX_SPF_LOOKUPS:
-                return "PERMERROR (too many DNS lookups)"
-            expanded = expand_macros(mech[len("redirect=") :], ip, domain, mail_from, helo)
-            redirect_target = normalize_domain(expanded)
+                return ("done", "PERMERROR (too many DNS lookups)")
+            expanded = expand_macros(p.arg, ip, domain, mail_from, helo)
+            frame["redirect_target"] = normalize_domain(expanded)
             continue
 
         # ip4:/ip6:
-        if mech.startswith(("ip4:", "ip6:")):
+        if kind == _K_IP4 or kind == _K_IP6:
+            version = 4 if kind == _K_IP4 else 6
+            trie = frame["trie4"] if version == 4 else frame["trie6"]
             try:
-                net = ipaddress.ip_network(mech.split(":", 1)[1], strict=False)
-                if ip_obj in net:
-                    matched = True
-                    return result_from_qualifier(qualifier)
+                _insert_cidr(trie, p.arg, qualifier, 32 if version == 4 else 128)
             except Exception:
-                return "PERMERROR (invalid ip mechanism)"
+                return ("done", "PERMERROR (invalid ip mechanism)")
+            if ip_obj.version == version and str(ip_obj) in trie:
+                return ("done", result_from_qualifier(qualifier))
             continue
 
         # include:
-        if mech.startswith("include:"):
+        if kind == _K_INCLUDE:
             state["spf_lookups"] += 1
             trace["lookups"] = state["spf_lookups"]
             if state["spf_lookups"] > MAX_SPF_LOOKUPS:
-                return "PERMERROR (too many DNS lookups)"
-
-            expanded = expand_macros(mech[len("include:") :], ip, domain, mail_from, helo)
-            target = normalize_domain(expanded)
-            result = evaluate_spf(target, ip, state, trace, depth + 1, mail_from, helo)
-
-            if result == "PASS":
-                matched = True
-                return result_from_qualifier(qualifier)
-            if result.startswith("PERMERROR") or result.startswith("TEMPEROR"):
-                return result  # Propagate hard errors
-            continue
+                return ("done", "PERMERROR (too many DNS lookups)")
+            expanded = expand_macros(p.arg, ip, domain, mail_from, helo)
+            return ("call", normalize_domain(expanded), qualifier)
 
         # a
-        if mech == "a" or mech.startswith(("a:", "a/")):
+        if kind == _K_A:
             state["spf_lookups"] += 1
             trace["lookups"] = state["spf_lookups"]
             if state["spf_lookups"] > MAX_SPF_LOOKUPS:
-                return "PERMERROR (too many DNS lookups)"
-            target, cidr = _parse_mechanism_target(mech, "a", domain, ip, mail_from, helo)
-            for addr in resolve_a_aaaa(target, trace, state["dns_cache"]):
-                if ip_matches(addr, cidr, ip_obj):
-                    matched = True
-                    return result_from_qualifier(qualifier)
+                return ("done", "PERMERROR (too many DNS lookups)")
+            target = _expand_target(p.arg, ip, domain, mail_from, helo)
+            if addrs_match(await resolve_a_aaaa(target, trace, ip_obj.version), p.cidr, ip_obj):
+                return ("done", result_from_qualifier(qualifier))
             continue
 
         # mx
-        if mech == "mx" or mech.startswith(("mx:", "mx/")):
+        if kind == _K_MX:
             state["spf_lookups"] += 1
             trace["lookups"] = state["spf_lookups"]
             if state["spf_lookups"] > MAX_SPF_LOOKUPS:
-                return "PERMERROR (too many DNS lookups)"
-            target, cidr = _parse_mechanism_target(mech, "mx", domain, ip, mail_from, helo)
-            for mx_host in resolve_mx(target, trace, state["dns_cache"]):
-                for addr in resolve_a_aaaa(mx_host, trace, state["dns_cache"]):
-                    if ip_matches(addr, cidr, ip_obj):
-                        matched = True
-                        return result_from_qualifier(qualifier)
+                return ("done", "PERMERROR (too many DNS lookups)")
+            target = _expand_target(p.arg, ip, domain, mail_from, helo)
+            # Resolve every distinct MX host in one gather: any host
+            # matching yields the same qualifier result, so overlapping
+            # the lookups cannot change the outcome.
+            mx_hosts = list(dict.fromkeys(await resolve_mx(target, trace)))
+            if mx_hosts:
+                per_host = await asyncio.gather(
+                    *(resolve_a_aaaa(h, trace, ip_obj.version) for h in mx_hosts)
+                )
+                for addrs in per_host:
+                    if addrs_match(addrs, p.cidr, ip_obj):
+                        return ("done", result_from_qualifier(qualifier))
             continue
 
         # exists:
-        if mech.startswith("exists:"):
+        if kind == _K_EXISTS:
             state["spf_lookups"] += 1
             trace["lookups"] = state["spf_lookups"]
             if state["spf_lookups"] > MAX_SPF_LOOKUPS:
-                return "PERMERROR (too many DNS lookups)"
-            expanded = expand_macros(mech[len("exists:") :], ip, domain, mail_from, helo)
+                return ("done", "PERMERROR (too many DNS lookups)")
+            expanded = expand_macros(p.arg, ip, domain, mail_from, helo)
             target = normalize_domain(expanded)
-            if check_exists(target, trace, state["dns_cache"]):
-                matched = True
-                return result_from_qualifier(qualifier)
+            if await check_exists(target, trace):
+                return ("done", result_from_qualifier(qualifier))
             continue
 
         # ptr (deprecated)
-        if mech.startswith("ptr"):
+        if kind == _K_PTR:
             log(trace, "Warning: ptr mechanism is deprecated")
             state["spf_lookups"] += 1
             trace["lookups"] = state["spf_lookups"]
             if state["spf_lookups"] > MAX_SPF_LOOKUPS:
-                return "PERMERROR (too many DNS lookups)"
+                return ("done", "PERMERROR (too many DNS lookups)")
             target_domain = domain
-            if ":" in mech:
-                expanded = expand_macros(mech.split(":", 1)[1], ip, domain, mail_from, helo)
+            if p.arg is not None:
+                expanded = expand_macros(p.arg, ip, domain, mail_from, helo)
                 target_domain = normalize_domain(expanded)
-            ptr_names = resolve_ptr(ip_obj, trace, state["dns_cache"])
-            for name in ptr_names:
-                if target_domain and not name.endswith("." + target_domain) and name != target_domain:
-                    continue
-
-                if any(addr == ip_obj for addr in resolve_a_aaaa(name, trace, state["dns_cache"])):
-                    matched = True
-                    return result_from_qualifier(qualifier)
+            ptr_names = await resolve_ptr(ip_obj, trace)
+            # Drop names outside the target domain before touching DNS,
+            # then validate the survivors' forward records in one gather,
+            # capped so a host with many PTRs cannot stampede the
+            # resolver.
+            suffix = "." + target_domain if target_domain else ""
+            candidates = [
+                name
+                for name in ptr_names
+                if not target_domain or name == target_domain or name.endswith(suffix)
+            ]
+            if candidates:
+                limit = asyncio.Semaphore(8)
+
+                async def _forward(name: str) -> List:
+                    async with limit:
+                        return await resolve_a_aaaa(name, trace, ip_obj.version)
+
+                for addrs in await asyncio.gather(*(_forward(n) for n in candidates)):
+                    if any(addr == ip_obj for addr in addrs):
+                        return ("done", result_from_qualifier(qualifier))
             continue
 
         # all
-        if mech == "all":
-            matched = True
+        if kind == _K_ALL:
             result = result_from_qualifier(qualifier)
-            if result == "FAIL" and exp_domain:
-                exp_txt = fetch_spf(exp_domain, trace)
-                if exp_txt and not exp_txt.startswith("PERMERROR"):
-                    explanation = expand_macros(exp_txt, ip, domain, mail_from, helo)
-                    log(trace, f"Explanation: {explanation}")
-            return result
+            if result == "FAIL" and frame["exp_template"]:
+                exp_domain = normalize_domain(
+                    expand_macros(frame["exp_template"], ip, domain, mail_from, helo)
+                )
+                if exp_domain:
+                    exp_txt = await fetch_spf(exp_domain, trace)
+                    if exp_txt and not exp_txt.startswith("PERMERROR"):
+                        explanation = expand_macros(exp_txt, ip, domain, mail_from, helo)
+                        log(trace, f"Explanation: {explanation}")
+            return ("done", result)
+
+        log(trace, f"Unknown mechanism ignored: {p.raw}")
+
+    if frame["redirect_target"]:
+        log(trace, f"Redirecting to: {frame['redirect_target']}")
+        return ("redirect", frame["redirect_target"])
+
+    return ("done", "NEUTRAL")
+
+
+async def evaluate_spf(
+    domain: str,
+    ip: str,
+    state: Optional[Dict] = None,
+    trace: Optional[Dict] = None,
+    depth: int = 0,
+    mail_from: Optional[str] = None,
+    helo: Optional[str] = None,
+) -> str:
+    if trace is None:
+        trace = {"steps": [], "lookups": 0}
+    if state is None:
+        state = {
+            "seen": set(),
+            "spf_lookups": 0,
+        }
 
-        log(trace, f"Unknown mechanism ignored: {mech}")
+    # Parsed once for the whole evaluation instead of per include level.
+    try:
+        ip_obj = ipaddress.ip_address(ip)
+    except ValueError:
+        return "PERMERROR (invalid IP address)"
 
+    # Explicit frame stack instead of recursion: an include suspends the
+    # parent frame and resumes it with the child's result, so deep SPF
+    # graphs pay neither Python call frames nor per-level re-setup.
+    stack: List[Tuple[Dict, str]] = []
+    current: Dict | str = await _open_frame(domain, depth, ip_obj, state, trace)
+
+    while True:
+        if isinstance(current, str):
+            result = current
+        else:
+            step = await _walk_frame(current, ip, ip_obj, state, trace, mail_from, helo)
+            if step[0] == "call":
+                stack.append((current, step[2]))
+                current = await _open_frame(step[1], current["depth"] + 1, ip_obj, state, trace)
+                continue
+            if step[0] == "redirect":
+                current = await _open_frame(step[1], current["depth"] + 1, ip_obj, state, trace)
+                continue
+            result = step[1]
 
-    if redirect_target and not matched:
-        log(trace, f"Redirecting to: {redirect_target}")
-        return evaluate_spf(redirect_target, ip, state, trace, depth + 1, mail_from, helo)
+        if not stack:
+            return result
 
-    return "NEUTRAL"
\ No newline at end of file
+        # Apply the include semantics while unwinding: PASS maps through
+        # the include's qualifier, hard errors propagate, anything else
+        # resumes the parent walk at the next mechanism.
+        parent, include_qualifier = stack.pop()
+        if result == "PASS":
+            current = result_from_qualifier(include_qualifier)
+        elif result.startswith("PERMERROR") or result.startswith("TEMPEROR"):
+            current = result
+        else:
+            current = parent
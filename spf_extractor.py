@@ -1,27 +1,97 @@
-import dns.resolver
+import asyncio
+import collections
+import re
+import sys
+import threading
+import time
+
+import dns.asyncresolver
+
+
+_resolver = dns.asyncresolver.Resolver()
+# Same tuning as the evaluator's resolver: a 4096-byte EDNS0 buffer so
+# long TXT answers fit in one datagram, short per-try waits, 3s total.
+_resolver.use_edns(0, 0, 4096)
+_resolver.timeout = 1.0
+_resolver.lifetime = 3.0
+
+# Fetched SPF records (including the PERMERROR markers and the None
+# no-record result) persist across evaluations, TTL-capped, so checking
+# many messages against the same sender graph pays each TXT round trip
+# once. Same shape as the DMARC TXT cache.
+_SPF_CACHE_MAX = 1024
+_SPF_TTL_MAX = 300
+_SPF_NEGATIVE_TTL = 30
+
+_spf_cache: dict[str, tuple[float, str | None]] = {}
+_spf_cache_lock = threading.Lock()
+
+# Control characters the TXT payload may not contain (tab/CR/LF are
+# tolerated); a compiled class scan runs in C instead of a per-char
+# Python loop.
+_CTRL_SEARCH = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]").search
 
 
 def normalize_domain(domain: str) -> str:
-    return domain.strip().lower().rstrip(".")
+    # Interning collapses the duplicate strings produced for the same
+    # domain across mechanisms and recursion levels, so the hot dict and
+    # set lookups keyed on domains hit the pointer-compare fast path.
+    return sys.intern(domain.strip().lower().rstrip("."))
 
 
-def fetch_spf(domain: str, trace=None) -> str | None:
+async def fetch_spf(domain: str, trace=None) -> str | None:
 
     domain = normalize_domain(domain)
     if trace is not None:
         trace["steps"].append(f"TXT lookup for {domain}")
 
+    now = time.monotonic()
+    with _spf_cache_lock:
+        hit = _spf_cache.get(domain)
+        if hit and hit[0] > now:
+            return hit[1]
+
+    record, ttl = await _fetch_spf_uncached(domain)
+
+    with _spf_cache_lock:
+        if len(_spf_cache) >= _SPF_CACHE_MAX:
+            _spf_cache.pop(next(iter(_spf_cache)))
+        _spf_cache[domain] = (now + ttl, record)
+
+    return record
+
+
+async def _fetch_spf_uncached(domain: str) -> tuple[str | None, int]:
     try:
-        answers = dns.resolver.resolve(domain, "TXT")
+        answers = await _resolver.resolve(domain, "TXT")
     except Exception:
-        return None
+        return None, _SPF_NEGATIVE_TTL
+
+    rrset_ttl = getattr(getattr(answers, "rrset", None), "ttl", None)
+    ttl = _SPF_TTL_MAX if rrset_ttl is None else min(rrset_ttl, _SPF_TTL_MAX)
 
     spf_records = []
 
     for rdata in answers:
         parts = getattr(rdata, "strings", None)
         if parts is None:
-            raw_parts = [str(rdata)]
+            first = str(rdata)
+            parts = None
+        else:
+            first = parts[0] if parts else ""
+            if isinstance(first, bytes):
+                first = first.decode()
+
+        # Cheapest discriminator first: unless the record's head looks
+        # like v=spf1, skip the decode, the join and the control-char
+        # scan -- most TXT answers are DKIM/verification records. A
+        # head shorter than the marker stays a candidate.
+        head = first[:16].replace('"', "").strip()
+        if len(head) >= 6 and head[:6].lower() != "v=spf1":
+            continue
+
+        if parts is None:
+            raw_parts = [first]
         else:
             raw_parts = [
                 part.decode() if isinstance(part, bytes) else part
@@ -29,8 +99,8 @@ def fetch_spf(domain: str, trace=None) -> str | None:
             ]
 
         for p in raw_parts:
-            if any(ord(ch) < 32 and ch not in ("\t", "\r", "\n") for ch in p):
-                return "PERMERROR: MALFORMED TXT"
+            if _CTRL_SEARCH(p):
+                return "PERMERROR: MALFORMED TXT", ttl
 
         txt = "".join(raw_parts).replace('"', "").strip()
 
@@ -38,12 +108,12 @@ def fetch_spf(domain: str, trace=None) -> str | None:
             spf_records.append(txt)
 
     if len(spf_records) > 1:
-        return "PERMERROR: MULTIPLE SPF RECORDS"
+        return "PERMERROR: MULTIPLE SPF RECORDS", ttl
 
     if not spf_records:
-        return None
+        return None, ttl
 
-    return spf_records[0]
+    return spf_records[0], ttl
 
 
 def parse_mechanisms(spf: str) -> list[str]:
@@ -55,53 +125,94 @@ def parse_mechanisms(spf: str) -> list[str]:
     return [t.strip() for t in spf.split()[1:] if t.strip()]
 
 
-def build_spf_tree(domain: str, seen=None) -> dict:
+def _reaches(src: dict, dst: dict) -> bool:
+    # Can dst be reached from src over already-built child links? Used
+    # to refuse edges that would close a cycle; the graph stays small
+    # (one node per domain), so the walk is cheap.
+    stack = [src]
+    seen = set()
+    while stack:
+        node = stack.pop()
+        if node is dst:
+            return True
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        stack.extend(node["children"])
+    return False
+
+
+async def build_spf_tree(domain: str) -> dict:
+    # Iterative breadth-first walk instead of one recursion per
+    # include:/redirect=. Nodes are memoized by domain, so a domain
+    # reached through several includes is fetched and expanded once and
+    # linked by reference -- diamond-shaped graphs come out as a DAG,
+    # not a duplicated tree -- and each BFS level's TXT fetches run in
+    # one gather so sibling includes overlap their round trips (the
+    # fetches also share fetch_spf's persistent record cache with the
+    # evaluator). Edges that would close a loop become LOOP-DETECTED
+    # stubs instead, so the result stays acyclic and JSON-serializable.
     domain = normalize_domain(domain)
 
-    if seen is None:
-        seen = set()
-
-    node = {
+    root = {
         "domain": domain,
         "spf": None,
         "mechanisms": [],
         "children": []
     }
 
-    if domain in seen:
-        node["mechanisms"].append("LOOP-DETECTED")
-        return node
-
-    seen.add(domain)
-
-    spf = fetch_spf(domain)
-
-    if spf is None:
-        node["mechanisms"].append("NO-SPF")
-        return node
-
-    if spf.startswith("PERMERROR"):
-        node["mechanisms"].append(spf)
-        return node
-
-    node["spf"] = spf
-    mechanisms = parse_mechanisms(spf)
-
-    for mech in mechanisms:
-        node["mechanisms"].append(mech)
-
-        if mech.startswith("redirect="):
-            target = mech.split("=", 1)[1]
-            node["children"].append(build_spf_tree(target, seen))
-
-        elif mech.startswith("include:"):
-            target = mech.split(":", 1)[1]
-            node["children"].append(build_spf_tree(target, seen))
-
-        else:
-            continue
-
-    return node
+    visited: dict[str, dict] = {domain: root}
+    frontier = collections.deque([root])
+
+    while frontier:
+        level = list(frontier)
+        frontier.clear()
+
+        records = await asyncio.gather(*(fetch_spf(n["domain"]) for n in level))
+
+        for node, spf in zip(level, records):
+            if spf is None:
+                node["mechanisms"].append("NO-SPF")
+                continue
+
+            if spf.startswith("PERMERROR"):
+                node["mechanisms"].append(spf)
+                continue
+
+            node["spf"] = spf
+
+            for mech in parse_mechanisms(spf):
+                node["mechanisms"].append(mech)
+
+                if mech.startswith("redirect="):
+                    target = mech.split("=", 1)[1]
+                elif mech.startswith("include:"):
+                    target = mech.split(":", 1)[1]
+                else:
+                    continue
+
+                target = normalize_domain(target)
+                child = visited.get(target)
+                if child is None:
+                    child = {
+                        "domain": target,
+                        "spf": None,
+                        "mechanisms": [],
+                        "children": []
+                    }
+                    visited[target] = child
+                    frontier.append(child)
+                elif _reaches(child, node):
+                    node["children"].append({
+                        "domain": target,
+                        "spf": None,
+                        "mechanisms": ["LOOP-DETECTED"],
+                        "children": []
+                    })
+                    continue
+                node["children"].append(child)
+
+    return root
 
 
 def print_tree(node: dict, indent: int = 0):